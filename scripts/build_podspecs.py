@@ -15,95 +15,151 @@
 # limitations under the License.
 
 import os
+import hashlib
 import json
-import random
-import string
 import argparse
+import concurrent.futures
+import dataclasses
+import functools
+import pathlib
 import subprocess
-import sys
-
-
-class TargetDependency(object):
-    def __init__(self, name):
-        self.name = name
+from operator import attrgetter
+
+try:
+    # orjson decodes considerably faster than the json module; use it if it's
+    # available.
+    from orjson import loads as load_json
+except ImportError:
+    from json import loads as load_json
+
+# CocoaPod names for the Swift packages we depend on.
+_POD_MAPPINGS = {
+    'swift-log': 'Logging',
+    'swift-nio': 'SwiftNIO',
+    'swift-nio-extras': 'SwiftNIOExtras',
+    'swift-nio-http2': 'SwiftNIOHTTP2',
+    'swift-nio-ssl': 'SwiftNIOSSL',
+    'swift-nio-transport-services': 'SwiftNIOTransportServices',
+    'SwiftProtobuf': 'SwiftProtobuf'
+}
+
+# CocoaPod names for gRPC Swift targets.
+_TARGET_MAP = {
+    'GRPC': 'gRPC-Swift',
+    'CGRPCZlib': 'CGRPCZlib'
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class TargetDependency:
+    name: str
 
     def __str__(self):
-        return "s.dependency '{name}', s.version.to_s".format(name=self.name)
+        return f"s.dependency '{self.name}', s.version.to_s"
 
 
-class ProductDependency(object):
-    def __init__(self, name, lower, upper):
-        self.name = name
-        self.lower = lower
-        self.upper = upper
+@dataclasses.dataclass(frozen=True)
+class ProductDependency:
+    name: str
+    lower: str
+    upper: str
 
     def __str__(self):
-        return "s.dependency '{name}', '>= {lower}', '< {upper}'".format(
-                name=self.name, lower=self.lower, upper=self.upper)
+        return f"s.dependency '{self.name}', '>= {self.lower}', '< {self.upper}'"
 
 
+@dataclasses.dataclass(frozen=True)
 class Pod:
-    def __init__(self, name, module_name, version, description, dependencies=None, is_plugins_pod=False):
-        self.name = name
-        self.module_name = module_name
-        self.version = version
-        self.is_plugins_pod = is_plugins_pod
-        self.dependencies = dependencies if dependencies is not None else []
-        self.description = description
-
-    def as_podspec(self):
-        print('\n')
-        print('Building Podspec for %s' % self.name)
-        print('-' * 80)
-
+    name: str
+    module_name: str
+    version: str
+    description: str
+    dependencies: tuple = ()
+    is_plugins_pod: bool = False
+
+    def __post_init__(self):
+        # Store dependencies as a tuple so that the pod is hashable.
+        object.__setattr__(self, 'dependencies', tuple(self.dependencies))
+
+    @functools.cached_property
+    def podspec(self):
         indent=' ' * 4
 
-        podspec = "Pod::Spec.new do |s|\n\n"
-        podspec += indent + "s.name = '%s'\n" % self.name
+        parts = ["Pod::Spec.new do |s|\n\n"]
+        parts.append(f"{indent}s.name = '{self.name}'\n")
         if not self.is_plugins_pod:
-            podspec += indent + "s.module_name = '%s'\n" % self.module_name
-        podspec += indent + "s.version = '%s'\n" % self.version
-        podspec += indent + "s.license = { :type => 'Apache 2.0', :file => 'LICENSE' }\n"
-        podspec += indent + "s.summary = '%s'\n" % self.description
-        podspec += indent + "s.homepage = 'https://www.grpc.io'\n"
-        podspec += indent + "s.authors  = { 'The gRPC contributors' => \'grpc-packages@google.com' }\n\n"
-
-        podspec += indent + "s.swift_version = '5.2'\n"
-        podspec += indent + "s.ios.deployment_target = '10.0'\n"
-        podspec += indent + "s.osx.deployment_target = '10.12'\n"
-        podspec += indent + "s.tvos.deployment_target = '10.0'\n"
-        podspec += indent + "s.watchos.deployment_target = '6.0'\n"
+            parts.append(f"{indent}s.module_name = '{self.module_name}'\n")
+        parts.append(f"{indent}s.version = '{self.version}'\n")
+        parts.append(indent + "s.license = { :type => 'Apache 2.0', :file => 'LICENSE' }\n")
+        parts.append(f"{indent}s.summary = '{self.description}'\n")
+        parts.append(indent + "s.homepage = 'https://www.grpc.io'\n")
+        parts.append(indent + "s.authors  = { 'The gRPC contributors' => \'grpc-packages@google.com' }\n\n")
+
+        parts.append(indent + "s.swift_version = '5.2'\n")
+        parts.append(indent + "s.ios.deployment_target = '10.0'\n")
+        parts.append(indent + "s.osx.deployment_target = '10.12'\n")
+        parts.append(indent + "s.tvos.deployment_target = '10.0'\n")
+        parts.append(indent + "s.watchos.deployment_target = '6.0'\n")
 
         if self.is_plugins_pod:
-            podspec += indent + "s.source = { :http => \"https://github.com/grpc/grpc-swift/releases/download/#{s.version}/protoc-grpc-swift-plugins-#{s.version}.zip\"}\n\n"
-            podspec += indent + "s.preserve_paths = '*'\n"
+            parts.append(indent + "s.source = { :http => \"https://github.com/grpc/grpc-swift/releases/download/#{s.version}/protoc-grpc-swift-plugins-#{s.version}.zip\"}\n\n")
+            parts.append(indent + "s.preserve_paths = '*'\n")
         else:
-            podspec += indent + "s.source = { :git => \"https://github.com/grpc/grpc-swift.git\", :tag => s.version }\n\n"
-            podspec += indent + "s.source_files = 'Sources/%s/**/*.{swift,c,h}'\n" % (self.module_name)
+            parts.append(indent + "s.source = { :git => \"https://github.com/grpc/grpc-swift.git\", :tag => s.version }\n\n")
+            parts.append(f"{indent}s.source_files = 'Sources/{self.module_name}/**/*.{{swift,c,h}}'\n")
 
-            podspec += "\n" if len(self.dependencies) > 0 else ""
+            if self.dependencies:
+                parts.append("\n")
 
-        for dep in sorted(self.dependencies, key=lambda x: x.name):
-            podspec += indent + str(dep) + "\n"
+        parts.append("".join(indent + str(dep) + "\n" for dep in self.dependencies))
 
-        podspec += "\nend"
-        return podspec
+        parts.append("\nend")
+        return "".join(parts)
 
 class PodManager:
-    def __init__(self, directory, version, should_publish, package_dump):
+    def __init__(self, directory, version, should_publish, package_dump, force_publish=False):
         self.directory = directory
+        self._directory_path = pathlib.Path(directory)
         self.version = version
         self.should_publish = should_publish
+        self.force_publish = force_publish
         self.package_dump = package_dump
+        # Index the package description by name to avoid repeatedly scanning it.
+        self._dependencies_by_name = {
+            dependency['name']: dependency for dependency in package_dump['dependencies']
+        }
+        self._targets_by_name = {
+            target['name']: target for target in package_dump['targets']
+        }
 
     def write(self, pod, contents):
-        print('    Writing to %s/%s.podspec ' % (self.directory, pod))
-        with open('%s/%s.podspec' % (self.directory, pod), 'w') as podspec_file:
+        print('\n')
+        print(f'Building Podspec for {pod}')
+        print('-' * 80)
+
+        path = self.podspec_path(pod)
+        try:
+            if path.read_text() == contents:
+                print(f'    {path} is unchanged')
+                return
+        except FileNotFoundError:
+            pass
+
+        print(f'    Writing to {path} ')
+        # Write to a temporary file and move it into place so that the podspec
+        # is never left partially written. Buffer the whole podspec so it is
+        # written with a single syscall.
+        temporary_path = path.with_suffix('.podspec.tmp')
+        with open(temporary_path, 'w', buffering=1 << 20) as podspec_file:
             podspec_file.write(contents)
+        temporary_path.replace(path)
+
+    def podspec_path(self, pod_name):
+        """Returns the path of the podspec for the given pod."""
+        return self._directory_path / f'{pod_name}.podspec'
 
     def publish(self, pod_name):
-        subprocess.check_call(['pod', 'repo', 'update'])
-        print('    Publishing %s.podspec' % (pod_name))
+        print(f'    Publishing {pod_name}.podspec')
 
         args = ['pod', 'trunk', 'push', '--synchronous']
 
@@ -116,10 +172,28 @@ class PodManager:
         if pod_name == "gRPC-Swift":
             args.append("--allow-warnings")
 
-        path_to_podspec = self.directory + '/' + pod_name + ".podspec"
-        args.append(path_to_podspec)
+        path_to_podspec = self.podspec_path(pod_name)
+        args.append(str(path_to_podspec))
         subprocess.check_call(args)
 
+        contents = path_to_podspec.read_text()
+        published_path = published_digest_path(pod_name)
+        os.makedirs(os.path.dirname(published_path), exist_ok=True)
+        with open(published_path, 'w') as published_file:
+            published_file.write(podspec_digest(contents))
+
+    def is_published(self, pod_name, contents):
+        """
+        Returns whether the given podspec contents are identical to those last
+        published for the pod.
+        """
+        published_path = published_digest_path(pod_name)
+        if not os.path.exists(published_path):
+            return False
+
+        with open(published_path) as published_file:
+            return published_file.read() == podspec_digest(contents)
+
     def build_pods(self):
         cgrpczlib_pod = Pod(
             self.pod_name_for_grpc_target('CGRPCZlib'),
@@ -154,35 +228,73 @@ class PodManager:
         if start_from:
             pods = pods[list(pod.name for pod in pods).index(start_from):]
 
-        # Create .podspec files and publish
+        # Create .podspec files
         for target in pods:
-            self.write(target.name, target.as_podspec())
-            if self.should_publish:
-                self.publish(target.name)
-            else:
-                print('    Skipping Publishing...')
+            self.write(target.name, target.podspec)
+
+        if self.should_publish:
+            # There's no need to push podspecs which haven't changed since they
+            # were last published, unless we've been told to.
+            unpublished = []
+            for target in pods:
+                if not self.force_publish and self.is_published(target.name, target.podspec):
+                    print(f'    {target.name}.podspec is already published')
+                else:
+                    unpublished.append(target)
+
+            pods = unpublished
+            if not pods:
+                return
+
+            # Update the spec repo once up front rather than before every push.
+            subprocess.check_call(['pod', 'repo', 'update'])
+            self.publish_all(pods)
+        else:
+            print('    Skipping Publishing...')
+
+    def publish_all(self, pods):
+        """
+        Publishes the given pods. Each pod is pushed as soon as the pods it
+        depends on have been pushed, so independent pods are pushed
+        concurrently.
+        """
+        names = set(pod.name for pod in pods)
+        # Dependencies on pods outside of this set are either provided by
+        # other packages or were published by an earlier run.
+        waiting_on = {
+            pod.name: set(dep.name for dep in pod.dependencies if dep.name in names)
+            for pod in pods
+        }
+
+        in_flight = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(pods), 1)) as executor:
+            while waiting_on or in_flight:
+                for name, dependencies in list(waiting_on.items()):
+                    if not dependencies:
+                        del waiting_on[name]
+                        in_flight[executor.submit(self.publish, name)] = name
+
+                if not in_flight:
+                    raise ValueError('Cyclic dependency between pods:', list(waiting_on))
+
+                done, _ = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = in_flight.pop(future)
+                    # Propagates any failure to publish.
+                    future.result()
+                    for dependencies in waiting_on.values():
+                        dependencies.discard(name)
 
 
     def pod_name_for_package(self, name):
         """Return the CocoaPod name for a given Swift package."""
-        pod_mappings = {
-            'swift-log': 'Logging',
-            'swift-nio': 'SwiftNIO',
-            'swift-nio-extras': 'SwiftNIOExtras',
-            'swift-nio-http2': 'SwiftNIOHTTP2',
-            'swift-nio-ssl': 'SwiftNIOSSL',
-            'swift-nio-transport-services': 'SwiftNIOTransportServices',
-            'SwiftProtobuf': 'SwiftProtobuf'
-        }
-        return pod_mappings[name]
+        return _POD_MAPPINGS[name]
 
 
     def pod_name_for_grpc_target(self, name):
         """Return the CocoaPod name for a given gRPC Swift target."""
-        return {
-          'GRPC': 'gRPC-Swift',
-          'CGRPCZlib': 'CGRPCZlib'
-        }[name]
+        return _TARGET_MAP[name]
 
 
     def get_package_requirements(self, package_name):
@@ -190,46 +302,48 @@ class PodManager:
         Returns the lower and upper bound version requirements for a given
         package dependency.
         """
-        for dependency in self.package_dump['dependencies']:
-            if dependency['name'] == package_name:
-                # There should only be 1 range.
-                requirement = dependency['requirement']['range'][0]
-                return (requirement['lowerBound'], requirement['upperBound'])
+        dependency = self._dependencies_by_name.get(package_name)
+        if dependency is None:
+            # This shouldn't happen.
+            raise ValueError('Could not find package called', package_name)
 
-        # This shouldn't happen.
-        raise ValueError('Could not find package called', package_name)
+        # There should only be 1 range.
+        requirement = dependency['requirement']['range'][0]
+        return (requirement['lowerBound'], requirement['upperBound'])
 
 
     def get_dependencies(self, target_name):
         """
-        Returns a tuple of dependency lists for a given target.
+        Returns a tuple of dependencies for a given target.
 
-        The first entry is the list of product dependencies; dependencies on
-        products from other packages. The second entry is a list of target
-        dependencies, i.e. dependencies on other targets within the package.
+        The first entry is the set of product dependencies; the packages
+        providing products depended upon by the target. The second entry is a
+        tuple of target dependencies, i.e. dependencies on other targets within
+        the package.
         """
-        for target in self.package_dump['targets']:
-            if target['name'] == target_name:
-                product_dependencies = set()
-                target_dependencies = []
-
-                for dependency in target['dependencies']:
-                    if 'product' in dependency:
-                        product_dependencies.add(dependency['product'][1])
-                    elif 'target' in dependency:
-                        target_dependencies.append(dependency['target'][0])
-                    else:
-                        raise ValueError('Unexpected dependency type:', dependency)
-
-                return (product_dependencies, target_dependencies)
+        target = self._targets_by_name.get(target_name)
+        if target is None:
+            # This shouldn't happen.
+            raise ValueError('Could not find dependency called', target_name)
+
+        product_dependencies = []
+        target_dependencies = []
+
+        for dependency in target['dependencies']:
+            if 'product' in dependency:
+                product_dependencies.append(dependency['product'][1])
+            elif 'target' in dependency:
+                target_dependencies.append(dependency['target'][0])
+            else:
+                raise ValueError('Unexpected dependency type:', dependency)
 
-        # This shouldn't happen.
-        raise ValueError('Could not find dependency called', target_name)
+        # A target may depend on several products from the same package.
+        return (frozenset(product_dependencies), tuple(target_dependencies))
 
 
     def build_dependency_list(self, target_name):
         """
-        Returns a list of dependencies for the given target.
+        Returns a list of dependencies for the given target, sorted by name.
 
         Dependencies may be either 'TargetDependency' or 'ProductDependency'.
         """
@@ -245,9 +359,74 @@ class PodManager:
             pod_name = self.pod_name_for_grpc_target(target_name)
             dependencies.append(TargetDependency(pod_name))
 
-        return dependencies
+        return sorted(dependencies, key=attrgetter('name'))
+
+
+def cache_directory():
+    """Returns the directory in which this script caches its state."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'grpc-podspecs')
+
+
+def podspec_digest(contents):
+    """Returns a digest of the given podspec contents."""
+    return hashlib.sha256(contents.encode()).hexdigest()
+
+
+def published_digest_path(pod_name):
+    """
+    Returns the path of the file holding the digest of the podspec last
+    published for the given pod.
+    """
+    return os.path.join(cache_directory(), 'published', pod_name + '.sha256')
+
+
+def package_dump_cache_path():
+    """
+    Returns the path at which the output of 'swift package dump-package' is
+    cached. The path is keyed on the contents of the package manifest and the
+    resolved package versions so that any change to either misses the cache.
+    """
+    digest = hashlib.blake2b()
+    for name in ('Package.swift', 'Package.resolved'):
+        digest.update(name.encode())
+        if os.path.exists(name):
+            with open(name, 'rb') as f:
+                digest.update(f.read())
+
+    return os.path.join(cache_directory(), digest.hexdigest() + '.json')
+
 
+def read_package_dump(use_cache):
+    """
+    Returns the parsed output of 'swift package dump-package', using the cached
+    copy if one exists for the current package manifest.
+    """
+    cache_path = package_dump_cache_path()
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            cached = cache_file.read()
+        try:
+            return load_json(cached)
+        except ValueError:
+            # The cached copy is corrupt; discard it and dump the package again.
+            os.unlink(cache_path)
 
+    lines = subprocess.check_output(["swift", "package", "dump-package"])
+    package_dump = load_json(lines)
+
+    # Write to a temporary file and move it into place so that an interrupted
+    # run never leaves a partially written cache behind.
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temporary_path = cache_path + '.tmp'
+    with open(temporary_path, 'w') as cache_file:
+        json.dump(package_dump, cache_file)
+    os.replace(temporary_path, cache_path)
+
+    return package_dump
+
+
+@functools.lru_cache(maxsize=None)
 def dir_path(path):
     if os.path.isdir(path):
         return path
@@ -277,6 +456,19 @@ def main():
         help='The name of the Podspec to start from.'
     )
 
+    parser.add_argument(
+        '--no-cache',
+        action='store_false',
+        dest='use_cache',
+        help='Ignore any cached package description and re-run \'swift package dump-package\'.'
+    )
+
+    parser.add_argument(
+        '--force-publish',
+        action='store_true',
+        help='Push every Podspec, including those identical to the last published version.'
+    )
+
     parser.add_argument('version')
     args = parser.parse_args()
 
@@ -289,11 +481,10 @@ def main():
         path = os.getcwd()
 
     print("Reading package description...")
-    lines = subprocess.check_output(["swift", "package", "dump-package"])
-    package_dump = json.loads(lines)
+    package_dump = read_package_dump(args.use_cache)
     assert(package_dump["name"] == "grpc-swift")
 
-    pod_manager = PodManager(path, version, should_publish, package_dump)
+    pod_manager = PodManager(path, version, should_publish, package_dump, args.force_publish)
     pod_manager.go(start_from)
 
     return 0
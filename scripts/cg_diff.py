@@ -13,12 +13,31 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+
+# This script compares the instruction counts in two cachegrind output files,
+# either as a per-function table or as a summary of the totals.
+#
+# Only the standard library is used so the script can also be run with PyPy:
+#
+#   pypy3 scripts/cg_diff.py cachegrind.out.1 cachegrind.out.2
+
 import argparse
 import enum
+import mmap
+import operator
 import os
+import re
+import stat
 import subprocess
 import sys
 
+# Formats for the header and each row of the diff table.
+_HEADER_FORMAT = "{:>14} | {:>14} | {:>14} | {:>7} | {}"
+_ROW_FORMAT = "{:14,} | {:14,} | {:+14,} | {:+7.3f} | {}\n"
+
+# The index of the column in each row for each sort key.
+_SORT_INDICES = {"file1": 0, "file2": 1, "delta": 2}
+
 
 class State(enum.Enum):
     READING_HEADERS = enum.auto()
@@ -30,6 +49,7 @@ class State(enum.Enum):
 class InstructionCounts(object):
     def __init__(self, events):
         self._events = events
+        self._event_to_index = {event: index for (index, event) in enumerate(events)}
         self._counts = {}
 
     @property
@@ -42,28 +62,38 @@ class InstructionCounts(object):
 
     def add(self, instruction, counts):
         """Add a list of counts or the given instruction."""
-        if instruction in self._counts:
-            existing = self._counts[instruction]
-            self._counts[instruction] = [a + b for (a, b) in zip(existing, counts)]
-        else:
+        existing = self._counts.get(instruction)
+        if existing is None:
             self._counts[instruction] = counts
+        else:
+            self._counts[instruction] = list(map(operator.add, existing, counts))
+
+    def event_index(self, event):
+        """The index of the given event within the counts of each instruction."""
+        return self._event_to_index[event]
 
     def count(self, instruction, event):
         """The number of occurrences of the event for the given instruction."""
         counts = self._counts.get(instruction)
-        index = self._events.index(event)
+        index = self.event_index(event)
         if counts:
             return counts[index]
         else:
             return 0
 
+    def counts_by_index(self, index):
+        """The number of occurrences of the event at the given index, keyed by instruction."""
+        return {
+            instruction: counts[index] for (instruction, counts) in self._counts.items()
+        }
+
     def aggregate(self):
         """Aggregates event counts over all instructions."""
         return [sum(x) for x in zip(*self._counts.values())]
 
     def aggregate_by_event(self, event):
         """Aggregates event counts over all instructions for a given event."""
-        return self.aggregate_by_index(self._events.index(event))
+        return self.aggregate_by_index(self.event_index(event))
 
     def aggregate_by_index(self, index):
         """Aggregates event counts over all instructions for the event at the given index."""
@@ -71,7 +101,17 @@ class InstructionCounts(object):
 
 
 class Parser(object):
-    HEADERS = ["desc:", "cmd:"]
+    HEADERS = ("desc:", "cmd:")
+
+    # Matches a single line of input, or a run of consecutive count lines.
+    # Files, functions and counts make up the bulk of the input and have their
+    # own groups; anything else is 'other' and is handled by the line-by-line
+    # state machine.
+    LINE = re.compile(
+        rb"^(?:fl=(?P<file>.*)|fn=(?P<function>.*)"
+        rb"|(?P<counts>\d+(?: \d+)+(?:\n\d+(?: \d+)+)*)|(?P<other>.*))$",
+        re.MULTILINE,
+    )
 
     def __init__(self):
         # Parsing state.
@@ -80,23 +120,27 @@ class Parser(object):
         self._file = None
         # Function for current instruction
         self._function = None
+        # Key for the current instruction, updated as the file and function
+        # change.
+        self._current_key = "???:???"
         # Instruction counts
         self._counts = None
+        # Line handlers for each state; None once parsing is complete.
+        self._handlers = {
+            State.READING_HEADERS: self._read_headers,
+            State.READING_INSTRUCTION: self._read_instruction,
+            State.READING_COUNTS: self._read_instruction_after_counts,
+            State.READING_SUMMARY: None,
+        }
 
     @property
     def counts(self):
         return self._counts
 
-    @property
-    def _key(self):
-        fl = "???" if self._file is None else self._file
-        fn = "???" if self._function is None else self._function
-        return fl + ":" + fn
-
     ### Helpers
 
     def _is_header(self, line):
-        return any(line.startswith(p) for p in Parser.HEADERS)
+        return line.startswith(Parser.HEADERS)
 
     def _read_events_header(self, line):
         if line.startswith("events:"):
@@ -115,18 +159,32 @@ class Parser(object):
             return None
         return line[3:].strip()
 
+    def _update_current_key(self):
+        fl = "???" if self._file is None else self._file
+        fn = "???" if self._function is None else self._function
+        # Interned as the key is looked up for every count line.
+        self._current_key = sys.intern(fl + ":" + fn)
+
+    def _set_function(self, function, reset_instruction):
+        self._function = function
+        self._file = None if reset_instruction else self._file
+        self._update_current_key()
+        return State.READING_INSTRUCTION
+
+    def _set_file(self, file, reset_instruction):
+        self._file = file
+        self._function = None if reset_instruction else self._function
+        self._update_current_key()
+        return State.READING_INSTRUCTION
+
     def _read_file_or_function(self, line, reset_instruction=False):
         function = self._read_function(line)
         if function is not None:
-            self._function = function
-            self._file = None if reset_instruction else self._file
-            return State.READING_INSTRUCTION
+            return self._set_function(function, reset_instruction)
 
         file = self._read_file(line)
         if file is not None:
-            self._file = file
-            self._function = None if reset_instruction else self._function
-            return State.READING_INSTRUCTION
+            return self._set_file(file, reset_instruction)
 
         return None
 
@@ -154,12 +212,33 @@ class Parser(object):
 
         return self._read_counts(line)
 
+    def _read_instruction_after_counts(self, line):
+        return self._read_instruction(line, reset_instruction=True)
+
     def _read_counts(self, line):
-        # Drop the line number
-        counts = [int(x) for x in line.split(" ")][1:]
-        self._counts.add(self._key, counts)
+        fields = line.split(" ")
+        # The line number is dropped, but parse it anyway so that lines which
+        # aren't counts are rejected.
+        int(fields[0])
+        counts = list(map(int, fields[1:]))
+        self._counts.add(self._current_key, counts)
         return State.READING_COUNTS
 
+    def _read_counts_block(self, block):
+        # Each line is a line number followed by a count for each event. Sum
+        # each column over the whole block and add the totals once, rather
+        # than adding every line separately. The block is bytes, which 'int'
+        # accepts directly.
+        values = list(map(int, block.split()))
+        stride = len(self._counts.events) + 1
+        if len(values) == (block.count(b"\n") + 1) * stride:
+            counts = [sum(values[i::stride]) for i in range(1, stride)]
+            self._counts.add(self._current_key, counts)
+        else:
+            # Not every line has a count for each event.
+            for line in block.split(b"\n"):
+                self._read_counts(line.decode("utf-8"))
+
     def _read_summary(self, line):
         if line.startswith("summary:"):
             summary = [int(x) for x in line[8:].strip().split(" ")]
@@ -173,12 +252,29 @@ class Parser(object):
 
     def parse(self, file, demangle):
         """Parse the given file."""
-        with open(file) as fh:
+        with open(file, "rb") as fh:
             if demangle:
-                demangled = subprocess.check_output(["swift", "demangle"], stdin=fh)
-                self._parse_lines(x.decode("utf-8") for x in demangled.splitlines())
+                # Parse the demangled output as it's produced rather than
+                # waiting for all of it.
+                args = ["swift", "demangle"]
+                with subprocess.Popen(
+                    args, stdin=fh, stdout=subprocess.PIPE, encoding="utf-8"
+                ) as proc:
+                    self._parse_lines(proc.stdout)
+
+                if proc.returncode != 0:
+                    raise subprocess.CalledProcessError(proc.returncode, args)
             else:
-                self._parse_lines(fh)
+                st = os.fstat(fh.fileno())
+                if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                    # Map the file and scan it as bytes: this avoids reading it
+                    # into memory and decoding all of it up front.
+                    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                        self._parse_buffer(buffer)
+                else:
+                    # Pipes and other special files can't be mapped (and
+                    # report a size of zero), so read them instead.
+                    self._parse_buffer(fh.read())
 
         return self._counts
 
@@ -186,19 +282,42 @@ class Parser(object):
         for line in lines:
             self._next_line(line)
 
+    def _parse_buffer(self, buffer):
+        # Scanning the whole buffer with a regular expression avoids splitting
+        # it into lines and testing each against every prefix in turn. Only
+        # file and function names, and lines handled by the state machine,
+        # are decoded.
+        for match in Parser.LINE.finditer(buffer):
+            kind = match.lastgroup
+            if kind == "other" or self._state is State.READING_HEADERS:
+                line = match.group(0)
+                if line:
+                    self._next_line(line.decode("utf-8"))
+                    if self._state is State.READING_SUMMARY:
+                        return
+            elif kind == "counts":
+                self._read_counts_block(match.group("counts"))
+                self._state = State.READING_COUNTS
+            else:
+                value = match.group(kind).strip().decode("utf-8")
+                reset_instruction = self._state is State.READING_COUNTS
+                if kind == "file":
+                    self._state = self._set_file(value, reset_instruction)
+                else:
+                    self._state = self._set_function(value, reset_instruction)
+
     def _next_line(self, line):
         """Parses a line of input."""
-        if self._state is State.READING_HEADERS:
-            self._state = self._read_headers(line)
-        elif self._state is State.READING_INSTRUCTION:
-            self._state = self._read_instruction(line)
-        elif self._state is State.READING_COUNTS:
-            self._state = self._read_instruction(line, reset_instruction=True)
-        elif self._state is State.READING_SUMMARY:
+        try:
+            handler = self._handlers[self._state]
+        except KeyError:
+            raise RuntimeError("Unexpected state", self._state)
+
+        if handler is None:
             # We're done.
             return
-        else:
-            raise RuntimeError("Unexpected state", self._state)
+
+        self._state = handler(line)
 
 
 def parse(filename, demangle):
@@ -222,67 +341,45 @@ def print_summary(args):
 
 def print_diff_table(args):
     counts1 = parse(args.file1, args.demangle)
-    aggregate1 = counts1.aggregate_by_event(args.event)
     counts2 = parse(args.file2, args.demangle)
-    aggregate2 = counts2.aggregate_by_event(args.event)
 
-    file1_total = aggregate1
-    diffs = []
+    # Extract the counts for the event from each file in a single pass. The
+    # event may be at a different index in each file.
+    event_counts1 = counts1.counts_by_index(counts1.event_index(args.event))
+    event_counts2 = counts2.counts_by_index(counts2.event_index(args.event))
+    aggregate1 = sum(event_counts1.values())
+    aggregate2 = sum(event_counts2.values())
 
-    def _count(key, counts):
-        block = counts.get(key)
-        return 0 if block is None else block.counts[0]
+    file1_total = aggregate1
+    rows = []
 
-    def _row(c1, c2, key):
+    def _add_row(c1, c2, key):
         delta = c2 - c1
         delta_pc = 100.0 * (delta / file1_total)
-        return (c1, c2, delta, delta_pc, key)
-
-    def _row_for_key(key):
-        c1 = counts1.count(key, args.event)
-        c2 = counts2.count(key, args.event)
-        return _row(c1, c2, key)
+        # Rows below the low watermark aren't printed, don't bother building
+        # and sorting them.
+        if abs(delta_pc) >= args.low_watermark:
+            rows.append((c1, c2, delta, delta_pc, key))
 
     if args.only_common:
-        keys = counts1.instructions & counts2.instructions
+        keys = event_counts1.keys() & event_counts2.keys()
     else:
-        keys = counts1.instructions | counts2.instructions
-
-    rows = [_row_for_key(k) for k in keys]
-    rows.append(_row(aggregate1, aggregate2, "PROGRAM TOTALS"))
-
-    print(
-        " | ".join(
-            [
-                "file1".rjust(14),
-                "file2".rjust(14),
-                "delta".rjust(14),
-                "%".rjust(7),
-                "name",
-            ]
-        )
-    )
+        keys = event_counts1.keys() | event_counts2.keys()
+
+    for key in keys:
+        _add_row(event_counts1.get(key, 0), event_counts2.get(key, 0), key)
+    _add_row(aggregate1, aggregate2, "PROGRAM TOTALS")
+
+    print(_HEADER_FORMAT.format("file1", "file2", "delta", "%", "name"))
 
     index = _sort_index(args.sort)
     reverse = not args.ascending
-    sorted_rows = sorted(rows, key=lambda x: x[index], reverse=reverse)
-    for (c1, c2, delta, delta_pc, key) in sorted_rows:
-        if abs(delta_pc) >= args.low_watermark:
-            print(
-                " | ".join(
-                    [
-                        "{:14,}".format(c1),
-                        "{:14,}".format(c2),
-                        "{:+14,}".format(delta),
-                        "{:+7.3f}".format(delta_pc),
-                        key,
-                    ]
-                )
-            )
+    sorted_rows = sorted(rows, key=operator.itemgetter(index), reverse=reverse)
+    sys.stdout.writelines(_ROW_FORMAT.format(*row) for row in sorted_rows)
 
 
 def _sort_index(key):
-    return ("file1", "file2", "delta").index(key)
+    return _SORT_INDICES[key]
 
 
 if __name__ == "__main__":